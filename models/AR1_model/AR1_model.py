@@ -96,6 +96,15 @@ if __name__ == '__main__':
     for k in kAxis:
         samples = np.append(samples, ar1.update())
 
+    # A second instance must give an independent timeseries
+    ar1_other = AR1_model(phi=0.3, mean=5, variance=10)
+    samples_other = np.array([ar1_other.update() for k in kAxis])
+
+    # Check the correlations: lag-1 should be close to phi,
+    # the one between the two instances close to zero
+    print("Lag-1 correlation = " + str(np.corrcoef(samples[:-1], samples[1:])[0,1]))
+    print("Correlation between instances = " + str(np.corrcoef(samples, samples_other)[0,1]))
+
     # Plot results
     plt.plot(kAxis, samples)
     plt.xlabel('Timestep')
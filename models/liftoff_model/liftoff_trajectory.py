@@ -204,7 +204,6 @@ class liftoff_trajectory:
             return
 
         # Grab states
-        print(type(all_x))
         for x in all_x:
             k = int(x.get('k'))
             for i in range(self.rocket.nx):
@@ -208,29 +208,17 @@ if __name__ == '__main__':
     us = np.zeros((spacecraft.nu,N))
     n_r_stop = 60
     n_theta_stop = 85
-    
-    us_r = np.zeros(N)
-    us_r[0:n_r_stop] = 0.1075 * np.ones(n_r_stop)
-    us[0,:] = us_r
-    
-    us_theta = np.zeros(N)
-    us_theta[0:n_theta_stop] = 0.2 * np.ones(n_theta_stop)
-    us[1,:] = us_theta
+    us[0,:n_r_stop] = 0.1075
+    us[1,:n_theta_stop] = 0.2
     
     # Simulate the system
-    xs = cas.DM.zeros((spacecraft.nx,N+1))
-    xs[:,0] = spacecraft.x0_scaled
-
+    xs = np.empty((spacecraft.nx,N+1))
+    xs[:,0] = spacecraft.x0_scaled.full().ravel()
     for k in range(1,N+1):
-        xs[:,k] = F(xs[:,k-1],us[:,k-1])
-
+        xs[:,k] = F(xs[:,k-1],us[:,k-1]).full().ravel()
 
     # Unscale trajectory
-    for k in range(N+1):
-        xs[:,k] = xs[:,k] * spacecraft.unscale
-
-
-    xs = xs.full()
+    xs = xs * spacecraft.unscale.full()
 
     # Prepare plotting
     tAxis = np.linspace(0, T-DT, N+1)
@@ -7,14 +7,15 @@
 #        a specified altitude. Uses multiple shooting.
 ##
 
-import sys, os
+import sys, os, ctypes, hashlib, shutil, subprocess, tempfile
 sys.path.append(os.path.realpath('../'))
 sys.path.append(os.getcwd())
 
 import casadi as cas
 import numpy as np
 from models.orbit_polar_model.orbit_polar_model import orbit_polar_model
-from integrators.rk4step import rk4step_L, rk4step_ode
+from models.kepler_orbit.kepler_orbit import kepler_orbit
+from utils.orbit_animator import orbit_animator
 
 # Create a spacecraft instance
 spacecraft = orbit_polar_model()
@@ -44,57 +45,79 @@ DT = T/N
 
 # Integration parameters
 nn = 10
-h = DT/nn
+
+# NLP solver: 'ipopt' or 'fatrop' (exploits the multiple shooting structure)
+nlp_solver = 'ipopt'
+
+# Compile the NLP callbacks just-in-time. Off by default: compiling the
+# NLP takes longer than solving it for N = 100.
+use_jit = False
+
+# Generate C code for the NLP callbacks and keep the compiled library in
+# a cache directory, so that later runs of the same problem can reuse it.
+use_codegen = False
+cache_dir = os.path.expanduser('~/.cache/spaceflight_playground')
+
+# Store the solution and start the next run from it, if the problem has
+# the same shape (N, nn). T and altitude_T may change between runs.
+use_warmstart = False
+warmstart_file = os.path.join(cache_dir, 'warmstart_orbit_polar.npz')
 
 # Values for terminal constraints
 altitude_T = 20 # [km]
 angVel_T = 10**3 * np.sqrt(spacecraft.mu / (spacecraft.R + 10**3 * altitude_T)**3)
 
+# Bind the scaled model constants to plain numpy values once
+x0_scaled = spacecraft.x0_scaled.full().ravel()
+scale = spacecraft.scale.full().ravel()
+me_scaled = spacecraft.me * scale[4]
+m0_scaled = spacecraft.m0 * scale[4]
+
 # Print out values
 print("== Terminal values ==")
 print("Altitude: " + str(altitude_T) + " km")
 print("Angular velocity: " + str(angVel_T) + " microrad")
 
 # Create system model in casadi
-x = cas.MX.sym('x', spacecraft.nx, 1)
-u = cas.MX.sym('u', spacecraft.nu, 1)
+x = cas.SX.sym('x', spacecraft.nx, 1)
+u = cas.SX.sym('u', spacecraft.nu, 1)
 f = cas.Function('f', [x,u], [spacecraft.dynamics_scaled(x,u)], ['x','u'], ['xdot'])
 
-# Create an integrator for the ode
-Xk = x
-for k in range(nn):
-    Xk = rk4step_ode(f, Xk, u, h)
-F = cas.Function('F', [x,u], [Xk], ['x','u'], ['xk'])
-
-# Create stage cost for the OCP
-l = u[0]**2 + u[1]**2
-l = cas.Function('l', [x,u], [l], ['x','u'], ['l'])
-
-# Create an integrator for the stage cost
-Lk = 0
-for k in range(nn):
-    Lk = rk4step_L(l, Lk, x, u, h)
-L = cas.Function('L', [x,u], [Lk], ['x','u'], ['L'])
+# Create an integrator for the ode and the stage cost of the OCP. The
+# fixed step rk integrator takes nn rk4 steps per interval and is
+# simplified into a plain function of (x0, p).
+dae = {'x': x, 'p': u, 'ode': f(x,u), 'quad': u[0]**2 + u[1]**2}
+integrator_opts = {}
+integrator_opts['number_of_finite_elements'] = nn
+integrator_opts['simplify'] = True
+integrator_opts['expand'] = True
+I = cas.integrator('I', 'rk', dae, 0, DT, integrator_opts)
+I_out = I(x0=x, p=u)
+F = cas.Function('F', [x,u], [I_out['xf']], ['x','u'], ['xk'])
+L = cas.Function('L', [x,u], [I_out['qf']], ['x','u'], ['L'])
+
+# Check that the Jacobian of F keeps its structural zeros (the angle does
+# not enter the dynamics, so it can not be dense w.r.t. x)
+F_jac_nnz = (F.sparsity_jac(0,0).nnz(), F.sparsity_jac(1,0).nnz())
+print("F Jacobian nonzeros (x, u): " + str(F_jac_nnz[0]) + ", " + str(F_jac_nnz[1]))
+if F_jac_nnz[0] == spacecraft.nx**2:
+    print("Warning: Jacobian of F w.r.t. x is dense, structural zeros got lost")
+
+# Create the circle constraint on the controls
+gc = cas.Function('gc', [u], [u[0]**2 + u[1]**2], ['u'], ['gc'])
 
 # Create an initial guess for the OCP by forward simulation
 us_init = np.zeros((N,spacecraft.nu))
 n_r_stop = 60
 n_theta_stop = 85
+us_init[:n_r_stop,0] = 0.1075
+us_init[:n_theta_stop,1] = 0.2
 
-us_r = np.zeros(N)
-us_r[0:n_r_stop] = 0.1075 * np.ones(n_r_stop)
-us_init[:,0] = us_r
-
-us_theta = np.zeros(N)
-us_theta[0:n_theta_stop] = 0.2 * np.ones(n_theta_stop)
-us_init[:,1] = us_theta
-
-xs = cas.DM.zeros((N+1, spacecraft.nx))
-xs[0,:] = spacecraft.x0_scaled
-for k in range(N):
-    xs[k+1,:] = F(xs[k,:],us_init[k,:])
-
-xs_init = xs.full()
+# Roll out all N intervals in a single call
+roll = F.mapaccum('roll', N)
+xs_init = np.empty((N+1, spacecraft.nx))
+xs_init[0,:] = x0_scaled
+xs_init[1:,:] = roll(x0_scaled, us_init.T).full().T
 
 # Print debug message
 print("== Initial guess ==")
@@ -103,12 +126,20 @@ print("us_init size: " + str(us_init.shape))
 print(xs_init)
 print("Initial guess computed. Now starting creation of OCP.")
 
-# Create the optimization variables
-X = cas.MX.sym('X', spacecraft.nx, N)
-U = cas.MX.sym('U', spacecraft.nu, N)
-
-# Start with empty NLP
-w = []      # Optimization variables (xs, us)
+# Create the optimization variables as one block. Every interval
+# contributes its control U_k followed by the state X_(k+1). Generated
+# code stays small with MX, which keeps F and L as function calls
+# instead of inlining all N intervals.
+nxnu = spacecraft.nx + spacecraft.nu
+if use_jit or use_codegen:
+    w = cas.MX.sym('W', N * nxnu)
+else:
+    w = cas.SX.sym('W', N * nxnu)
+W = cas.reshape(w, nxnu, N)
+U = W[:spacecraft.nu,:]
+X = W[spacecraft.nu:,:]
+
+# Start with empty NLP, the pieces are concatenated once at the end
 w0 = []     # Initial guess
 lbw = []    # Lower bound on opt. variables
 ubw = []    # Upper bound on opt. variables
@@ -117,67 +148,65 @@ g = []      # Nonlinear constraints
 lbg = []    # Lower bound on constraints
 ubg = []    # Upper bound on constraints
 
+# Bounds on states
+lbw_k = [0.0, -cas.inf, -cas.inf, -cas.inf, me_scaled]
+ubw_k = [cas.inf, cas.inf, cas.inf, cas.inf, m0_scaled]
+
 # Formulate NLP
 Xk = xs_init[0,:]
 for k in range(N):
     
     # NLP variable for control
-    Uk = cas.MX.sym('U_' + str(k), spacecraft.nu, 1)
-    w = cas.vertcat(w, Uk)
-    lbw = cas.vertcat(lbw, -cas.inf, -cas.inf)
-    ubw = cas.vertcat(ubw,  cas.inf,  cas.inf)
-    w0 = cas.vertcat(w0, us_init[k,:])
-
-    # Circle constraints on controls
-    g = cas.vertcat(g, Uk[0]**2 + Uk[1]**2)
-    lbg = cas.vertcat(lbg, 0)
-    ubg = cas.vertcat(ubg, 1)
+    Uk = U[:,k]
+    lbw += [-cas.inf, -cas.inf]
+    ubw += [ cas.inf,  cas.inf]
+    w0 += list(us_init[k,:])
 
     # Integrate till the end of the interval
     Xk_end = F(Xk, Uk)
     J = J + L(Xk, Uk)
 
     # New NLP variable for state
-    Xk = cas.MX.sym('X_' + str(k+1), spacecraft.nx, 1)
-    w = cas.vertcat(w, Xk)
-    lbw_k = cas.vertcat(
-        0.0,
-        -cas.inf,
-        -cas.inf,
-        -cas.inf,
-        spacecraft.me * spacecraft.scale[4]
-    )
-    ubw_k = cas.vertcat(
-        cas.inf,
-        cas.inf,
-        cas.inf,
-        cas.inf,
-        spacecraft.m0 * spacecraft.scale[4]
-    )
-    lbw = cas.vertcat(lbw, lbw_k)
-    ubw = cas.vertcat(ubw, ubw_k)
-    w0 = cas.vertcat(w0, xs_init[k+1,:])
+    Xk = X[:,k]
+    lbw += lbw_k
+    ubw += ubw_k
+    w0 += list(xs_init[k+1,:])
+
+    # Equality constraints to match intervals. They come first in every
+    # interval and are written as X_(k+1) - F(X_k, U_k), which is the
+    # shooting structure that fatrop detects.
+    g.append(Xk - Xk_end)
+    lbg += [0] * spacecraft.nx
+    ubg += [0] * spacecraft.nx
 
-    # Equality constraints to match intervals
-    g = cas.vertcat(g, Xk_end - Xk)
-    lbg = cas.vertcat(lbg, cas.DM.zeros(spacecraft.nx, 1))
-    ubg = cas.vertcat(ubg, cas.DM.zeros(spacecraft.nx, 1))
+    # Circle constraints on controls
+    g.append(gc(Uk))
+    lbg.append(0)
+    ubg.append(1)
 
 
 # Terminal constraint on altitude
-g = cas.vertcat(g, Xk_end[0])
-lbg = cas.vertcat(lbg, altitude_T)
-ubg = cas.vertcat(ubg, altitude_T)
+g.append(Xk_end[0])
+lbg.append(altitude_T)
+ubg.append(altitude_T)
 
 # Terminal constraint on radial velocity
-g = cas.vertcat(g, Xk_end[2])
-lbg = cas.vertcat(lbg, 0)
-ubg = cas.vertcat(ubg, 0)
+g.append(Xk_end[2])
+lbg.append(0)
+ubg.append(0)
 
 # Terminal constraint on angular velocity
-g = cas.vertcat(g, Xk_end[3])
-lbg = cas.vertcat(lbg, angVel_T)
-ubg = cas.vertcat(ubg, angVel_T)
+g.append(Xk_end[3])
+lbg.append(angVel_T)
+ubg.append(angVel_T)
+
+# Concatenate the NLP pieces
+g = cas.vertcat(*g)
+w0 = cas.DM(w0)
+lbw = cas.DM(lbw)
+ubw = cas.DM(ubw)
+lbg = cas.DM(lbg)
+ubg = cas.DM(ubg)
 
 # Print debug message
 print("== OCP created ==")
@@ -198,9 +227,123 @@ nlp['x'] = w
 nlp['g'] = g
 
 opts = {}
-#opts['ipopt.print_level'] = 0
-opts['ipopt.print_info_string'] = 'yes'
-solver = cas.nlpsol('solver', 'ipopt', nlp, opts)
+if nlp_solver == 'fatrop':
+    # Flag the gap-closing constraints (and the terminal constraints) as
+    # equalities, the circle constraints as inequalities
+    opts['structure_detection'] = 'auto'
+    opts['equality'] = [bool(lb == ub) for lb, ub in zip(lbg.nonzeros(), ubg.nonzeros())]
+    opts['fatrop.max_iter'] = 200
+
+else:
+    # Pick the first linear solver that IPOPT is able to load. The HSL
+    # solvers are a lot faster than MUMPS but are distributed separately
+    # as a shared library, so look for their symbols before using them.
+    hsl_symbols = {'ma57': 'ma57ad_', 'ma97': 'ma97_analyse_d', 'ma27': 'ma27ad_'}
+    hsl_libs = {}
+    for hsl_name in ['libhsl.so', 'libcoinhsl.so']:
+        try:
+            hsl_libs[hsl_name] = ctypes.CDLL(hsl_name)
+        except OSError:
+            pass
+
+    linear_solver = 'mumps'
+    hsl_lib = None
+    for solver_name in ['ma57', 'ma97', 'ma27']:
+        for hsl_name, lib in hsl_libs.items():
+            if hasattr(lib, hsl_symbols[solver_name]):
+                linear_solver = solver_name
+                hsl_lib = hsl_name
+                break
+        if hsl_lib is not None:
+            break
+    print("Linear solver: " + linear_solver)
+
+    #opts['ipopt.print_level'] = 0
+    opts['ipopt.print_info_string'] = 'yes'
+    opts['ipopt.linear_solver'] = linear_solver
+    if hsl_lib is not None:
+        # Load the HSL solvers from the library the symbols were found in
+        opts['ipopt.hsllib'] = hsl_lib
+    if linear_solver == 'ma57':
+        opts['ipopt.ma57_automatic_scaling'] = 'yes'
+    opts['ipopt.mu_strategy'] = 'adaptive'
+
+    # Pass linear constraints on single variables to IPOPT as bounds
+    opts['detect_simple_bounds'] = True
+    opts['ipopt.fixed_variable_treatment'] = 'make_parameter'
+    opts['ipopt.bound_relax_factor'] = 0
+
+    # The constraint Jacobians depend on the iterate
+    opts['ipopt.jac_c_constant'] = 'no'
+    opts['ipopt.jac_d_constant'] = 'no'
+
+    # Give up early on runs that are most likely diverging, and accept
+    # solutions that stay good enough for a number of iterations
+    opts['ipopt.max_iter'] = 200
+    opts['ipopt.max_cpu_time'] = 30.0
+    opts['ipopt.acceptable_iter'] = 15
+    opts['ipopt.acceptable_tol'] = 1e-4
+
+# Load the primal and dual solution of the last run
+warmstart = None
+warmstart_params = np.array([N, nn], dtype=float)
+if use_warmstart and os.path.isfile(warmstart_file):
+    with np.load(warmstart_file) as warmstart_npz:
+        warmstart = {key: np.array(warmstart_npz[key]) for key in warmstart_npz.files}
+    if ('params' not in warmstart
+            or not np.array_equal(warmstart['params'], warmstart_params)
+            or warmstart['x'].size != w.numel()
+            or warmstart['lam_g'].size != g.numel()):
+        print("Ignoring warm start from " + warmstart_file + " (different problem)")
+        warmstart = None
+if warmstart is not None:
+    print("Warm start from " + warmstart_file)
+    if nlp_solver == 'ipopt':
+        opts['ipopt.warm_start_init_point'] = 'yes'
+        opts['ipopt.warm_start_bound_push'] = 1e-9
+        opts['ipopt.warm_start_mult_bound_push'] = 1e-9
+        opts['ipopt.mu_init'] = 1e-6
+
+# Generate C code for the NLP callbacks and compile it before solving.
+# The binary is tuned for the host cpu (-march=native) and is not portable.
+# Not needed when the callbacks are loaded from the code generation cache.
+if use_jit and not use_codegen:
+    opts['jit'] = True
+    opts['compiler'] = 'shell'
+    opts['jit_options'] = {'flags': ['-O3', '-march=native']}
+    opts['jit_name'] = 'nlp_orbit_polar_N' + str(N) + '_nn' + str(nn)
+    opts['jit_temp_suffix'] = False
+solver = cas.nlpsol('solver', nlp_solver, nlp, opts)
+
+# Compile the NLP callbacks into a shared library named after a hash of
+# the generated code, and load the solver from it
+if use_codegen:
+    codegen_name = 'nlp_orbit_polar'
+    # Generate the C file in a temporary directory (generate_dependencies
+    # only accepts a plain file name) and always clean it up
+    codegen_dir = tempfile.mkdtemp(prefix=codegen_name + '_')
+    codegen_src = os.path.join(codegen_dir, codegen_name + '.c')
+    cwd = os.getcwd()
+    try:
+        os.chdir(codegen_dir)
+        try:
+            solver.generate_dependencies(codegen_name + '.c')
+        finally:
+            os.chdir(cwd)
+        with open(codegen_src, 'rb') as codegen_file:
+            codegen_hash = hashlib.sha1(codegen_file.read()).hexdigest()[:16]
+        codegen_lib = os.path.join(cache_dir, codegen_name + '_' + codegen_hash + '.so')
+        if not os.path.isfile(codegen_lib):
+            print("Compiling NLP callbacks to " + codegen_lib)
+            os.makedirs(cache_dir, exist_ok=True)
+            subprocess.check_call([
+                'gcc', '-O3', '-march=native', '-shared', '-fPIC',
+                codegen_src, '-o', codegen_lib
+            ])
+    finally:
+        shutil.rmtree(codegen_dir, ignore_errors=True)
+    print("Loading NLP callbacks from " + codegen_lib)
+    solver = cas.nlpsol('solver', nlp_solver, codegen_lib, opts)
 
 # Solve the NLP
 solver_in = {}
@@ -209,24 +352,58 @@ solver_in['lbx'] = lbw
 solver_in['ubx'] = ubw
 solver_in['lbg'] = lbg
 solver_in['ubg'] = ubg
+if warmstart is not None:
+    solver_in['x0'] = warmstart['x']
+    solver_in['lam_x0'] = warmstart['lam_x']
+    solver_in['lam_g0'] = warmstart['lam_g']
 solver_out = solver(**solver_in)
 print("== OCP solved ==")
 
-# Extract results
-sol = solver_out['x']
-print("sol size: " + str(sol.shape) + ", type: " + str(type(sol)))
-
-u_opt = cas.DM.zeros((N,spacecraft.nu))
-x_opt = cas.DM.zeros((N,spacecraft.nx))
-
-nxnu = spacecraft.nx + spacecraft.nu
+# Save the solution for warm starting the next run, but only if the
+# solver converged (not after hitting the iteration or time limit)
+if use_warmstart and solver.stats()['success']:
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(warmstart_file,
+        params = warmstart_params,
+        x = solver_out['x'].full(),
+        lam_x = solver_out['lam_x'].full(),
+        lam_g = solver_out['lam_g'].full()
+    )
 
-u_opt[:,0] = sol[0::nxnu]
-u_opt[:,1] = sol[1::nxnu]
-x_opt[:,0] = sol[2::nxnu]
-x_opt[:,1] = sol[3::nxnu]
-x_opt[:,2] = sol[4::nxnu]
-x_opt[:,3] = sol[5::nxnu]
-x_opt[:,4] = sol[6::nxnu]
+# Extract results. Every row of the reshaped solution holds U_k, X_(k+1)
+w_opt = solver_out['x'].full().ravel()
+print("w_opt size: " + str(w_opt.shape) + ", type: " + str(type(w_opt)))
+
+U_opt = w_opt.reshape(N, nxnu)[:,:spacecraft.nu]
+X_opt = w_opt.reshape(N, nxnu)[:,spacecraft.nu:]
+
+# Prepend the initial state and unscale the states back to (m, rad, ..)
+X_opt_unscaled = np.vstack((x0_scaled, X_opt)) * spacecraft.unscale.full().ravel()
+
+# Target orbit
+orbit_target = kepler_orbit()
+orbit_target.fromPolarState(
+    rho = spacecraft.R + 1e3 * altitude_T,
+    theta = 0.0,
+    rhoDot = 0.0,
+    thetaDot = 1e-3 * angVel_T
+)
+
+# Animate the optimal trajectory
+anim_params = {
+    'T': T,
+    'N': N+1, # Number of states, including the initial one
+    'body_radius': spacecraft.R,
+    'target_orbit': orbit_target,
+    'isCartesian': False,
+    'rhos': X_opt_unscaled[:,0] + spacecraft.R,
+    'thetas': X_opt_unscaled[:,1],
+    'rhoDots': X_opt_unscaled[:,2],
+    'thetaDots': X_opt_unscaled[:,3],
+    'rhoForces': spacecraft.u_max * U_opt[:,0],
+    'thetaForces': spacecraft.u_max * U_opt[:,1]
+}
+anim = orbit_animator(anim_params)
+anim.run(10)
 
 # Write to .xml file
\ No newline at end of file
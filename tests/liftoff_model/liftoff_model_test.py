@@ -16,6 +16,7 @@ import casadi as cas
 from integrators.rk4step import rk4step_ode
 from models.liftoff_model.liftoff_model import liftoff_model
 from models.liftoff_model.liftoff_trajectory import liftoff_trajectory
+from models.AR1_model.AR1_model import AR1_model
 
 
 # Create a spacecraft instance
@@ -42,6 +43,10 @@ DT = T/N
 nn = 10     # Integrator steps per step
 h = DT/nn   # Step size of integrator step
 
+# Compile the discretized dynamics just-in-time. Off by default: compiling
+# takes longer than simulating the system.
+use_jit = False
+
 # Create system model with CasADi
 x = cas.MX.sym('x', spacecraft.nx, 1)
 u = cas.MX.sym('u', spacecraft.nu + spacecraft.nd, 1)
@@ -52,8 +57,20 @@ Xk = x
 for k in range(nn):
     Xk = rk4step_ode(f, Xk, u, h)
 
+# Options for the just-in-time compilation (tuned for the host cpu)
+jit_opts = {}
+if use_jit:
+    jit_opts['jit'] = True
+    jit_opts['compiler'] = 'shell'
+    jit_opts['jit_options'] = {'flags': ['-O3', '-march=native']}
+    jit_opts['jit_name'] = 'liftoff_F_nn' + str(nn)
+    jit_opts['jit_temp_suffix'] = False
+
 F = cas.Function('F', [x,u], [Xk], ['x','u'], ['xk'])
 
+# Expand into a scalar (SX) graph to eliminate common subexpressions
+F = F.expand('F', jit_opts)
+
 # Choose controls for simulation
 wind_forces = np.zeros((spacecraft.nd, N))
 controls = np.zeros((spacecraft.nu, N))
@@ -67,14 +84,28 @@ print(us[:,0])
 xdot_test = spacecraft.dynamics(spacecraft.x0, us[:,0])
 print(xdot_test)
 
-# Simulate the system
-xs = cas.DM.zeros((spacecraft.nx, N+1))
-xs[:,0] = spacecraft.x0
-
-for k in range(1,N+1):
-    xs[:,k] = F(xs[:,k-1], us[:,k-1])
-
-xs = xs.full()
+# Simulate the system in a single call
+roll = F.mapaccum('roll', N)
+xs = np.empty((spacecraft.nx, N+1))
+xs[:,0] = spacecraft.x0.full().ravel()
+xs[:,1:] = roll(spacecraft.x0, us).full()
+
+# Monte-Carlo sweep over wind disturbances. The M trajectories are
+# independent, so each step is evaluated for all of them in parallel.
+M = 16
+F_par = F.map(M, 'thread', 8)
+# Every trajectory draws its wind from its own AR(1) process
+winds = [AR1_model(phi=0.3, mean=0, variance=1e6) for i in range(M)]
+wind_forces_mc = np.zeros((spacecraft.nd, M, N))
+for i in range(M):
+    for k in range(N):
+        wind_forces_mc[:,i,k] = winds[i].update()
+
+xs_mc = np.empty((spacecraft.nx, M, N+1))
+xs_mc[:,:,0] = np.repeat(spacecraft.x0.full(), M, axis=1)
+for k in range(N):
+    us_mc = np.append(np.repeat(controls[:,k:k+1], M, axis=1), wind_forces_mc[:,:,k], axis=0)
+    xs_mc[:,:,k+1] = F_par(xs_mc[:,:,k], us_mc).full()
 
 # Prepare plotting
 tAxis = np.linspace(0, T, N+1)
@@ -105,6 +136,12 @@ plt.subplot(326)
 plt.plot(tAxis, xs[5,:])
 plt.ylabel('angular vel. [rad/s]')
 
+# Plot the Monte-Carlo sweep
+plt.figure(2)
+plt.plot(tAxis, xs_mc[0,:,:].T)
+plt.xlabel('time [s]')
+plt.ylabel('x-pos [m]')
+
 plt.show()
 
 
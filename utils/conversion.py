@@ -60,7 +60,7 @@ def state_pol2cart (x_pol):
     thetaDot = np.array([0, 0, thetaDot])
 
     # Compute radial and rotational velocities in cartesian frame
-    vel_rad = np.array([rhoDot, 0, 0])
+    vel_rad = rhoDot * np.array([np.cos(theta), np.sin(theta), 0])
     vel_rot = np.cross(thetaDot, pos)
 
     # Add up velocities
@@ -98,30 +98,43 @@ def state_pol2cart (x_pol):
 ##        
 def traj_pol2cart (xs_pol, us_pol):
 
-    # Get the trajectory length
-    N_x = xs_pol[0,:].size
-    N_u = us_pol[0,:].size
-
-    # Check if trajectories are compatible
-    if (N_x != N_u+1):
-        print("Error in traj_pol2cart: N_x != N_u + 1. Check your input.")
-        print("N_x = " + str(N_x))
-        print("N_u = " + str(N_u))
-        return -1
+    # Get the trajectories
+    rhos = np.asarray(xs_pol[0], dtype=float)
+    thetas = np.asarray(xs_pol[1], dtype=float)
+    rhoDots = np.asarray(xs_pol[2], dtype=float)
+    thetaDots = np.asarray(xs_pol[3], dtype=float)
+    u_rhos = np.asarray(us_pol[0], dtype=float)
+    u_thetas = np.asarray(us_pol[1], dtype=float)
 
-    # Convert all state vectors to cartesian coordinates
-    xs_cart = np.zeros((4,N_x))
-    for k in range(N_x):
-        xs_cart[:,k] = state_pol2cart(xs_pol[:,k])
+    # Get the trajectory length
+    N_x = thetas.size
+    N_u = u_rhos.size
+
+    # Check if trajectories are compatible. There is either one control
+    # per state or one less (none at the final state).
+    if (N_u not in (N_x, N_x-1) or u_thetas.size != N_u):
+        raise ValueError(
+            "traj_pol2cart: control trajectories must have length "
+            + str(N_x) + " or " + str(N_x-1)
+            + ", got " + str(N_u) + " and " + str(u_thetas.size)
+        )
+
+    # Convert all state vectors to cartesian coordinates:
+    # velocity = rhoDot * e_rho + rho * thetaDot * e_theta
+    c = np.cos(thetas)
+    s = np.sin(thetas)
+    xs_cart = np.array([
+        rhos * c,
+        rhos * s,
+        rhoDots * c - rhos * thetaDots * s,
+        rhoDots * s + rhos * thetaDots * c
+    ])
 
     # Convert controls by using the corotating reference frame
-    us_cart = us_pol
-    for k in range(N_u):
-        theta = xs_pol[1,k]
-        rotation = np.array(
-            [[np.cos(theta), -np.sin(theta)],
-             [np.sin(theta),  np.cos(theta)]])
-        us_cart[:,k] = np.dot(rotation, us_cart[:,k])
+    us_cart = np.array([
+        u_rhos * c[:N_u] - u_thetas * s[:N_u],
+        u_rhos * s[:N_u] + u_thetas * c[:N_u]
+    ])
 
     # return
     return xs_cart, us_cart
@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import numpy as np
 import models.kepler_orbit.kepler_orbit as orbit
+from utils.conversion import traj_pol2cart
 
 ##
 # @class orbit_animator
@@ -45,24 +46,34 @@ class orbit_animator:
 
         # If they're cartesian, take them as they are
         if (self.coordsAreCartesian):
-            self.xPositions = params['xPositions']
-            self.yPositions = params['yPositions']
-            self.xVelocities = params['xVelocities']
-            self.yVelocities = params['yVelocities']
-            self.xForces = params['xForces']
-            self.yForces = params['yForces']
+            self.xPositions = np.asarray(params['xPositions'], dtype=float)
+            self.yPositions = np.asarray(params['yPositions'], dtype=float)
+            self.xVelocities = np.asarray(params['xVelocities'], dtype=float)
+            self.yVelocities = np.asarray(params['yVelocities'], dtype=float)
+            self.xForces = np.asarray(params['xForces'], dtype=float)
+            self.yForces = np.asarray(params['yForces'], dtype=float)
 
         # If they're polar, convert them
         else:
-            rhos = params['rhos']
-            thetas = params['thetas']
-            rhoDots = params['rhoDots']
-            thetaDots = params['thetaDots']
-            rhoForces = params['rhoForces']
-            thetaForces = params['thetaForces']
-
-            # Stack them up into xs_pol, us_pol TODO
-            # Convert into cartesian coordinates TODO
+            xs_pol = [
+                params['rhos'],
+                params['thetas'],
+                params['rhoDots'],
+                params['thetaDots']
+            ]
+            us_pol = [
+                params['rhoForces'],
+                params['thetaForces']
+            ]
+
+            # Convert into cartesian coordinates
+            xs_cart, us_cart = traj_pol2cart(xs_pol, us_pol)
+            self.xPositions = xs_cart[0]
+            self.yPositions = xs_cart[1]
+            self.xVelocities = xs_cart[2]
+            self.yVelocities = xs_cart[3]
+            self.xForces = us_cart[0]
+            self.yForces = us_cart[1]
 
         # Configure figure
         margin = 2
@@ -125,10 +136,27 @@ class orbit_animator:
         )
 
 
+    ##
+    # @brief Draws the first frame of the dynamic objects. Is used by
+    #        matplotlib.animation
+    # @return The updated artists
+    ##
+    def animation_init(self):
+
+        # Line plot for trajectory
+        self.trajectory_plot.set_data(
+            self.trajectory[0],
+            self.trajectory[1]
+        )
+
+        return self.trajectory_plot, self.orbit_osculating_plot
+
+
     ## 
     # @brief Updates all the dynamic objects in the plot. Is used by 
     #        matplotlib.animation
     # @param i Index of the data
+    # @return The updated artists
     ## 
     def animation_main(self,i):
 
@@ -156,7 +184,7 @@ class orbit_animator:
 
         #print(orbit_osculating_samples)
 
-        return self.trajectory_plot#, self.orbit_osculating_plot
+        return self.trajectory_plot, self.orbit_osculating_plot
 
 
     ##
@@ -168,8 +196,10 @@ class orbit_animator:
         anim = animation.FuncAnimation(
             fig = self.fig,
             func = self.animation_main,
+            init_func = self.animation_init,
             frames = np.arange(1,self.N),
-            interval = 100/fps
+            interval = 1000/fps,
+            blit = True
         )
 
         # Save to file if needed